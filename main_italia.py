@@ -29,14 +29,17 @@ def main():
         exit()
 
     df = fs.read_sheet(inventory_file, dtype={'EAN': str})
-    if ln := df.duplicated(subset=['EAN']).sum():
+    if ln := df['EAN'].duplicated().sum():
         print('Warning: {} duplicated EANs in the inventory file.'.format(ln))
-    products = df.to_dict('records')
+    # The scraper only reads EAN and url, so skip building full row dicts
+    products = [{'EAN': ean, 'url': url}
+                for ean, url in zip(df['EAN'].tolist(), df['url'].tolist())]
 
 
     # Difox
     difox = Difox(username, password, file_directory, test_env=(os.getenv('env_type') == 'test'),
-                  headless=True, profile=os.getenv('chrome_profile'))  # type: ignore
+                  headless=True, profile=os.getenv('chrome_profile'), cache_file='{}/difox-italia-scrape-cache'.format(file_directory),
+                  cache_ttl=float(os.getenv('cache_ttl', 3600)))  # type: ignore
     try:
         difox.handle_login()
         difox.update_products(
@@ -1,24 +1,157 @@
-from typing import Tuple
+from typing import Optional, Tuple
 import pandas as pd
 from tqdm import tqdm
 import os
-from concurrent.futures import ThreadPoolExecutor
+import re
+import math
+import time
+import shelve
+import queue
+import multiprocessing
+import threading
+from collections import Counter, namedtuple
+from lxml import etree, html as lxml_html
+from lxml.cssselect import CSSSelector
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from urllib.parse import urlencode, urljoin, urlsplit, parse_qsl
 
 from modules.warp import SeleniumWrap
 from modules import files as fs
 from modules import utility
 
+# Compiled once at import instead of on every product page
+SEL_TITLE = CSSSelector('.productDisplay__title')
+SEL_EAN = CSSSelector('.is--eanCode')
+SEL_PRICE = CSSSelector('.price__price')
+SEL_AVAILABLE = CSSSelector('.is--available')
+SEL_FLASH_MESSAGE = CSSSelector('.layout__flashMessageWrapper')
+SEL_RESULT_COUNT = CSSSelector('.displayProducts__number')
+SEL_ARTICLE_LINK = CSSSelector('.displayProducts__chooseView article a[href]')
+CATALOG_PAGE_SIZE = 100
+SESSION_TIMEOUT_MSG = 'Your session ran out. Please login again.'
+
+# Rows written by update_products, field names double as the sheet headers
+ProductRow = namedtuple('ProductRow', ['EAN', 'price', 'quantity'])
+BadProductRow = namedtuple('BadProductRow', ['EAN', 'error', 'url'])
+
+
+def _parse_product(html: str, url: str) -> Tuple[dict, str]:
+    product = {}
+    err = ''
+
+    try:
+        root = lxml_html.fromstring(html)
+
+        # Session Timeout check
+        msg = SEL_FLASH_MESSAGE(root)
+        if msg and msg[0].text_content().strip() == SESSION_TIMEOUT_MSG:
+            return product, SESSION_TIMEOUT_MSG
+
+        # Product name
+        title = SEL_TITLE(root)
+        assert title, 'Product name not found'
+        product_name = title[0].text_content().strip()
+
+        # Product EAN
+        meta = SEL_EAN(root)
+        assert meta, 'Product EAN not found'
+        product_ean = meta[0].text_content().replace('EAN code:', '').strip()
+
+        # Product price
+        price_div = SEL_PRICE(root)
+        assert price_div, 'Product price not found'
+        price = utility.price_float(price_div[0].text_content().strip())
+
+        # Product quantity
+        stock_text = SEL_AVAILABLE(root)
+        quantity = 5 if stock_text else 0
+
+        product = {
+            'EAN': product_ean,
+            'product_name': product_name,
+            'price': price,
+            'quantity': quantity,
+            'url': url
+        }
+    except AssertionError as e:
+        err = str(e)
+    except etree.ParserError:
+        err = 'Product page is empty'
+
+    return product, err
+
+
+def _catalog_page_url(catalog_url: str, page: int) -> str:
+    parts = urlsplit(catalog_url)
+    query = dict(parse_qsl(parts.query))
+    query.update({'pageSize': CATALOG_PAGE_SIZE, 'page': page})
+    return parts._replace(query=urlencode(query)).geturl()
+
+
+def _parse_catalog_page(html: str, url: str) -> Tuple[list[str], int]:
+    try:
+        root = lxml_html.fromstring(html)
+    except etree.ParserError:
+        return [], 0
+
+    # First link of every article, as the browser version collected
+    product_urls = []
+    seen_articles = set()
+    for link in SEL_ARTICLE_LINK(root):
+        article = next(link.iterancestors('article'))
+        if article not in seen_articles:
+            seen_articles.add(article)
+            product_urls.append(urljoin(url, link.get('href')))
+
+    # Total result count, the last number in the text
+    total = 0
+    result_txt = SEL_RESULT_COUNT(root)
+    if result_txt:
+        numbers = re.findall(r'\d[\d.,]*', result_txt[0].text_content())
+        if numbers:
+            total = int(re.sub(r'\D', '', numbers[-1]))
+
+    return product_urls, total
+
 
 class Difox():
+    # Matches the connection pool size of the shared requests session
+    max_workers: int = 32
 
-    def __init__(self, username, password, file_directory: str, test_env: bool = False, headless: bool = False, profile: str = ''):
+    def __init__(self, username, password, file_directory: str, test_env: bool = False, headless: bool = False, profile: str = '', cache_file: str = '', cache_ttl: float = 3600, network_log: bool = False):
         self.username = username
         self.password = password
         self.file_directory = file_directory
         self.test_env = test_env
+        self.login_lock = threading.Lock()
+        self.login_generation = 0
+
+        # Scraped products by url as (fetched_at, product), reused for cache_ttl seconds.
+        # Each entry point passes its own cache_file, shelve can't be shared between processes.
+        # Only the thread that opened it may use the shelf (dbm.sqlite3 enforces this),
+        # so workers never touch it, lookups and stores happen in the result loops.
+        self.cache_ttl = cache_ttl
+        self.cache = None
+        self.cache_writes = 0
+        if cache_file and cache_ttl > 0:
+            try:
+                self.cache = shelve.open(cache_file)
+                self.prune_cache()
+                print('Reusing products scraped in the last {} sec, set cache_ttl=0 in the .env file to disable.'.format(
+                    int(cache_ttl)))
+            except Exception:
+                print('Scrape cache "{}" could not be opened, running without it.'.format(
+                    cache_file))
+                self.cache = None
+
+        # Parsing runs in worker processes so it doesn't hold the GIL for the fetch threads.
+        # Spawned rather than forked, forking a process running many threads can deadlock.
+        self.parse_pool = ProcessPoolExecutor(
+            max_workers=os.cpu_count(), mp_context=multiprocessing.get_context('spawn'))
 
         self.se = SeleniumWrap()
-        driver = self.se.setup_driver(headless=headless, profile=profile)
+        driver = self.se.setup_driver(
+            headless=headless, profile=profile, network_log=network_log, load_images=False)
         assert driver, 'Failed to setup chrome'
 
         # Visit Home page
@@ -30,6 +163,17 @@ class Difox():
         self.accept_all_cookies()
         self.se.wait_random_time(2, 3)
 
+    def __del__(self):
+        try:
+            self.parse_pool.shutdown(cancel_futures=True)
+        except AttributeError:
+            pass
+        try:
+            if self.cache is not None:
+                self.cache.close()
+        except AttributeError:
+            pass
+
     def accept_all_cookies(self):
         self.se.find_element_by_visible_text(
             'span', 'Accept all cookies', click=True, print_error=False)
@@ -40,6 +184,7 @@ class Difox():
         # Check if already logged in
         if self.se.find_element(is_logged_in_selector, print_error=False, timeout=2):
             print('Already logged in.')
+            self.se.sync_session_cookies()
             return True
 
         # Login form
@@ -55,74 +200,86 @@ class Difox():
         # Check if login successful
         if self.se.find_element(is_logged_in_selector):
             print('Login successful.')
+            self.se.sync_session_cookies()
             return True
 
         print('Login failed.')
         return False
 
-    def scrape_product(self, url: str, add_cookies=True) -> Tuple[dict, str]:
-        product = {}
-        err = ''
+    def find_product_api(self, url: str) -> list[str]:
+        # Lists the JSON requests a product page makes, candidates to replace the HTML scrape.
+        # Needs Difox(..., network_log=True).
+        self.se.get_json_responses()
+        self.se.get_page(url, sleep=3)
+        return self.se.get_json_responses()
+
+    def refresh_cookies(self, url: str) -> bool:
+        # Reuse the browser's cookies if they are still valid, only fill the login form if not
+        self.se.sync_session_cookies()
+        html = self.se.get_html_by_requests(url, print_error=False)
+        if html and SESSION_TIMEOUT_MSG not in html:
+            return True
 
-        try:
-            soup = self.se.get_page_by_requests(
-                url, add_cookies=add_cookies, print_error=False)
-            assert soup, 'Product page not found'
-
-            # Session Timeout check
-            msg = soup.select_one('.layout__flashMessageWrapper')
-            if msg and msg.text.strip() == 'Your session ran out. Please login again.':
-                if not self.handle_login():
-                    print('Cannot Login.')
-                    exit()
-
-            # Product name
-            title = soup.select_one('.productDisplay__title')
-            assert title, 'Product name not found'
-            product_name = title.text.strip()
-
-            # Product EAN
-            meta = soup.select_one('.is--eanCode')
-            assert meta, 'Product EAN not found'
-            product_ean = meta.text.replace('EAN code:', '').strip()
-
-            # Product price
-            price_div = soup.select_one('.price__price')
-            assert price_div, 'Product price not found'
-            price = utility.price_float(price_div.text.strip())
-
-            # Product quantity
-            stock_text = soup.select_one('.is--available')
-            quantity = 5 if stock_text else 0
-
-            product = {
-                'EAN': product_ean,
-                'product_name': product_name,
-                'price': price,
-                'quantity': quantity,
-                'url': url
-            }
-        except AssertionError as e:
-            err = str(e)
+        # Reload so the login check doesn't see a stale logged in page
+        self.se.driver.refresh()
+        return self.handle_login()
+
+    def prune_cache(self) -> None:
+        now = time.time()
+        expired = [url for url, (fetched_at, _) in self.cache.items()
+                   if now - fetched_at >= self.cache_ttl]
+        for url in expired:
+            del self.cache[url]
+
+    def cached_product(self, url: str) -> Optional[dict]:
+        if self.cache is None:
+            return None
+
+        cached = self.cache.get(url)
+        if cached and time.time() - cached[0] < self.cache_ttl:
+            return cached[1]
+        return None
+
+    def cache_product(self, product: dict) -> None:
+        if self.cache is None:
+            return
+
+        self.cache[product['url']] = (time.time(), product)
+
+        # Flushed regularly so a crash doesn't lose the whole cache
+        self.cache_writes += 1
+        if self.cache_writes % 100 == 0:
+            self.cache.sync()
+
+    def scrape_product(self, url: str, add_cookies=True, relogin=True) -> Tuple[dict, str]:
+        # Selenium is only touched again if the login session ran out
+        html = self.se.get_html_by_requests(
+            url, add_cookies=add_cookies, print_error=False)
+        # HTTP failures are reported apart from missing elements on a loaded page
+        if html is None:
+            return {}, 'Product page request failed'
+
+        product, err = self.parse_pool.submit(_parse_product, html, url).result()
+        if err == SESSION_TIMEOUT_MSG and relogin:
+            generation = self.login_generation
+            with self.login_lock:
+                # Another thread may have refreshed the session while this one waited
+                if generation == self.login_generation:
+                    if not self.refresh_cookies(url):
+                        print('Cannot Login.')
+                        exit()
+                    self.login_generation += 1
+            return self.scrape_product(url, add_cookies=False, relogin=False)
 
         return product, err
 
-    def update_product(self, product):
-        new_product, err = self.scrape_product(product['url'])
+    def product_row(self, product, new_product, err):
         if err:
-            return {
-                'EAN': product['EAN'],
-                'error': err,
-                'url': product['url']
-            }, err
+            return BadProductRow(product['EAN'], err, product['url']), err
         else:
-            return {
-                'EAN': product['EAN'],
-                'price': new_product['price'],
-                'quantity': new_product['quantity'],
-            }, None
+            return ProductRow(product['EAN'], new_product['price'], new_product['quantity']), None
 
-    def update_products(self, products: list[dict], updated_inventory_file: str, bad_product_file: str) -> list[dict]:
+    def update_products(self, products: list[dict], updated_inventory_file: str, bad_product_file: str) -> None:
         if self.test_env:
             print('Test mode: Only 10 products updating.')
             products = products[:10]
@@ -130,25 +287,99 @@ class Difox():
         print('\nProduct Availability and Price Update:')
         print('Inventory size: {} Products'.format(len(products)))
 
-        updated_products = []
+        quantities = Counter()
         bad_products = []
 
-        with ThreadPoolExecutor(max_workers=15) as executor:
-            for new_product, err in tqdm(executor.map(self.update_product, products), desc='Updating', colour='yellow', total=len(products)):
-                if err:
-                    bad_products.append(new_product)
-                else:
-                    updated_products.append(new_product)
+        # Updated products are written by a background thread as they arrive
+        rows = queue.Queue(maxsize=1000)
+        writer = threading.Thread(target=fs.write_queue_to_sheet, args=(
+            rows, updated_inventory_file, ProductRow._fields))
+        writer.start()
 
-        df = pd.DataFrame(updated_products)
-        fs.write_to_sheet(df, updated_inventory_file)
-        fs.write_to_sheet(pd.DataFrame(bad_products), bad_product_file)
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor, \
+                    tqdm(desc='Updating', colour='yellow', total=len(products)) as progress:
+
+                def collect(product, new_product, err):
+                    row, err = self.product_row(product, new_product, err)
+                    if err:
+                        bad_products.append(row)
+                    else:
+                        rows.put(row)
+                        quantities[row.quantity] += 1
+                    progress.update()
+
+                # Only a bounded window of products is in flight, refilled as results finish
+                # so a slow url doesn't hold back the rest. Cached products skip the pool.
+                remaining = iter(products)
+                pending = {}
+                while True:
+                    for product in remaining:
+                        cached = self.cached_product(product['url'])
+                        if cached:
+                            collect(product, cached, '')
+                        else:
+                            pending[executor.submit(
+                                self.scrape_product, product['url'])] = product
+                        if len(pending) >= 2 * self.max_workers:
+                            break
+                    if not pending:
+                        break
+
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        product = pending.pop(future)
+                        new_product, err = future.result()
+                        if not err:
+                            self.cache_product(new_product)
+                        collect(product, new_product, err)
+        finally:
+            rows.put(fs.QUEUE_END)
+            writer.join()
+
+        fs.write_to_sheet(pd.DataFrame.from_records(
+            bad_products, columns=BadProductRow._fields), bad_product_file)
 
         print('Updated: {}, In stock: {}, Out of stock: {}, Bad Product: {}'.format(
-            len(df), df['quantity'].value_counts().get(5), df['quantity'].value_counts().get(0), len(bad_products)))
-        return updated_products
+            sum(quantities.values()), quantities[5], quantities[0], len(bad_products)))
 
     def product_urls_by_catalogue(self, catalog_url: str) -> list[str]:
+        # Catalog pages are requested directly over the shared session instead of clicking through them
+        url = _catalog_page_url(catalog_url, 1)
+        html = self.se.get_html_by_requests(url, add_cookies=True)
+        if html is None:
+            print('Catalog page not found {}'.format(catalog_url))
+            return []
+
+        product_urls, total = _parse_catalog_page(html, url)
+        if not product_urls or not total:
+            print('Products not found in catalog html, using the browser {}'.format(
+                catalog_url))
+            return self.product_urls_by_browser(catalog_url)
+
+        # Page count from the articles actually served, in case pageSize was ignored
+        pages = math.ceil(total / len(product_urls))
+        page_urls = [_catalog_page_url(catalog_url, page)
+                     for page in range(2, pages + 1)]
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            htmls = list(executor.map(self.se.get_html_by_requests, page_urls))
+
+        for page_url, page_html in zip(page_urls, htmls):
+            if page_html is None:
+                print('Catalog page not found {}'.format(page_url))
+                continue
+            page_product_urls, _ = _parse_catalog_page(page_html, page_url)
+
+            # The site ignored the page parameter, fall back to clicking through
+            if page_product_urls and page_product_urls == product_urls[:len(page_product_urls)]:
+                print('Catalog pagination not supported, using the browser {}'.format(
+                    catalog_url))
+                return self.product_urls_by_browser(catalog_url)
+            product_urls += page_product_urls
+
+        return product_urls
+
+    def product_urls_by_browser(self, catalog_url: str) -> list[str]:
         product_urls = []
 
         try:
@@ -195,17 +426,22 @@ class Difox():
         print('Finding Inventory Unlisted Products:')
         print('Inventory size: {} Products'.format(len(products)))
 
-        EANs = [product['EAN'] for product in products]
-        URLs = [product['url'] for product in products]
+        EANs = frozenset(product['EAN'] for product in products)
+        URLs = frozenset(product['url'] for product in products)
         err_count = 0
 
         if self.test_env:
             print('Test mode: Only 3 catalogs and 10 product per catalog.')
             catalogs = catalogs[:3]
 
+        sub_directory = os.path.join(
+            self.file_directory, 'category_of_interest')
+        if not os.path.exists(sub_directory):
+            os.mkdir(sub_directory)
+
         print('Total Catalogs: {}'.format(len(catalogs)))
         for i, catalog in enumerate(catalogs):
-            unlisted = []
+            collected = 0
 
             product_urls = list(
                 set(self.product_urls_by_catalogue(catalog['url'])))
@@ -218,26 +454,29 @@ class Difox():
             print('{}. Catalogue: {}, Items: {}, In Inventory: {}, To Collect: {}, '.format(
                 i+1, catalog['name'], len(product_urls), len(in_inventory), len(product_urls_filtered)), end='')
 
-            with ThreadPoolExecutor(max_workers=15) as executor:
-                for new_product, err in executor.map(self.scrape_product, product_urls_filtered, [True] * len(product_urls_filtered)):
+            # Rows are written in batches while scraping instead of one DataFrame per catalog
+            filename = os.path.join(sub_directory, '{}'.format(
+                catalog.get('filename', 'Unnamed')))
+            with fs.SheetWriter(filename, ['EAN', 'product_name', 'quantity']) as writer, \
+                    ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                to_scrape = []
+                for url in product_urls_filtered:
+                    new_product = self.cached_product(url)
+                    if new_product is None:
+                        to_scrape.append(url)
+                    elif new_product['EAN'] not in EANs:
+                        writer.writerow(new_product)
+                        collected += 1
+
+                for new_product, err in executor.map(self.scrape_product, to_scrape):
                     if err:
                         err_count += 1
                         continue
-                    elif new_product['EAN'] not in EANs:
-                        unlisted.append({
-                            'EAN': new_product['EAN'],
-                            'product_name': new_product['product_name'],
-                            'quantity': new_product['quantity'],
-                        })
-
-            # Write to csv
-            sub_directory = os.path.join(
-                self.file_directory, 'category_of_interest')
-            if not os.path.exists(sub_directory):
-                os.mkdir(sub_directory)
-            filename = os.path.join(sub_directory, '{}'.format(
-                catalog.get('filename', 'Unnamed')))
-            fs.write_to_sheet(pd.DataFrame(unlisted), filename)
-            print('Collected: {}'.format(len(unlisted)))
+                    self.cache_product(new_product)
+                    if new_product['EAN'] not in EANs:
+                        writer.writerow(new_product)
+                        collected += 1
+
+            print('Collected: {}'.format(collected))
 
         print('Error count: {}'.format(err_count))
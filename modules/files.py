@@ -1,3 +1,4 @@
+import csv
 import pandas as pd
 import traceback
 
@@ -53,4 +54,90 @@ def write_to_sheet(df, filename='output.csv'):
         write_to_sheet(df, filename)
     except Exception:
         traceback.print_exc()
-        
+
+
+class SheetWriter:
+    """Writes rows as they arrive: csv files are flushed every `batch_size`
+    rows, other sheet types are written once on close. Rows are dicts or
+    tuples in `fieldnames` order."""
+
+    def __init__(self, filename, fieldnames, batch_size=500):
+        self.filename = filename
+        self.fieldnames = fieldnames
+        self.batch_size = batch_size
+        self.rows = []
+        self.file = None
+        self.writer = None
+        self.closed = False
+
+        if filename.endswith('.csv'):
+            self.file = self._open(filename)
+            self.writer = csv.writer(self.file)
+            self.writer.writerow(fieldnames)
+
+    def _open(self, filename):
+        while True:
+            try:
+                return open(filename, 'w', newline='', encoding='utf-8')
+            except PermissionError:
+                print(f'File: "{filename}" is open with another software')
+                input('Close the file and press ENTER to save data...')
+
+    def writerow(self, row):
+        if isinstance(row, dict):
+            row = tuple(row.get(field) for field in self.fieldnames)
+        self.rows.append(row)
+        if self.writer and len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.writer:
+            self.writer.writerows(self.rows)
+            self.file.flush()
+            self.rows = []
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+
+        if self.writer:
+            self.flush()
+            self.file.close()
+        else:
+            write_to_sheet(pd.DataFrame(
+                self.rows, columns=self.fieldnames), self.filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Put on the queue to tell write_queue_to_sheet there are no more rows
+QUEUE_END = None
+
+
+def write_queue_to_sheet(rows, filename, fieldnames, batch_size=500):
+    # Always drains the queue until QUEUE_END, even if the sheet can't be written,
+    # so the producer never blocks on a full queue
+    writer = None
+    try:
+        writer = SheetWriter(filename, fieldnames, batch_size=batch_size)
+    except Exception:
+        traceback.print_exc()
+
+    for row in iter(rows.get, QUEUE_END):
+        if writer is None:
+            continue
+        try:
+            writer.writerow(row)
+        except Exception:
+            traceback.print_exc()
+
+    if writer is not None:
+        try:
+            writer.close()
+        except Exception:
+            traceback.print_exc()
@@ -1,9 +1,13 @@
 import os
+import json
 import pickle
 import time
 import random
 import requests
-from requests.exceptions import ConnectTimeout, ReadTimeout, SSLError
+from requests.adapters import HTTPAdapter
+from requests.cookies import RequestsCookieJar
+from requests.exceptions import ConnectionError as RequestsConnectionError, ConnectTimeout, ReadTimeout, SSLError
+from urllib3.util.retry import Retry
 from bs4 import BeautifulSoup
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
@@ -27,7 +31,17 @@ class SeleniumWrap:
     error_file: str = 'error.log'
 
     def __init__(self):
-        pass
+        # Shared across threads so product requests reuse pooled keep-alive connections
+        self.session = requests.Session()
+
+        # Transient server errors and rate limits are retried with backoff,
+        # the last response is returned instead of raising once retries run out
+        retry = Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504],
+                      respect_retry_after_header=True, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=32,
+                              pool_maxsize=32, max_retries=retry)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
 
     def __del__(self):
         try:
@@ -39,7 +53,7 @@ class SeleniumWrap:
             pass
 
     # Setup driver with best practice options
-    def setup_driver(self, headless: bool = True, profile: Optional[str] = None, proxy: Optional[str] = None) -> webdriver.Chrome:
+    def setup_driver(self, headless: bool = True, profile: Optional[str] = None, proxy: Optional[str] = None, network_log: bool = False, load_images: bool = True) -> webdriver.Chrome:
         options = Options()
         service = Service()
 
@@ -47,10 +61,15 @@ class SeleniumWrap:
             options.add_argument('--headless=new')
         if profile:
             options.add_argument(f'--user-data-dir={profile}')
+            # Only a persistent profile keeps the cache across runs
+            options.add_argument('--disk-cache-size=104857600')
         if proxy:
             plugin = self.proxy_extension(proxy)
             if plugin:
                 options.add_extension(plugin)
+        if network_log:
+            # Lets get_json_responses read DevTools network events
+            options.set_capability('goog:loggingPrefs', {'performance': 'ALL'})
 
         [options.add_argument(argument) for argument in [
             '--start-maximized',
@@ -72,6 +91,8 @@ class SeleniumWrap:
                 'profile.password_manager_enabled': False
             }
         }
+        if not load_images:
+            experimental_options['prefs']['profile.managed_default_content_settings.images'] = 2
         [options.add_experimental_option(key, value)
          for key, value in experimental_options.items()]
 
@@ -102,21 +123,50 @@ class SeleniumWrap:
 
         return None
 
-    def get_page_by_requests(self, url: str, print_error: bool = True, add_cookies: bool = False) -> Optional[BeautifulSoup]:
+    def get_json_responses(self) -> list[str]:
+        # Reading the performance log also clears it
+        urls = []
         try:
-            session = requests.Session()
+            for entry in self.driver.get_log('performance'):
+                message = json.loads(entry['message'])['message']
+                if message['method'] != 'Network.responseReceived':
+                    continue
+                response = message['params']['response']
+                if 'json' in response.get('mimeType', ''):
+                    urls.append(response['url'])
+        except Exception:
+            self.unhandled_exception()
+
+        return urls
+
+    def sync_session_cookies(self) -> None:
+        # DevTools returns every browser cookie, not only those visible to the current page
+        try:
+            cookies = self.driver.execute_cdp_cmd(
+                'Network.getAllCookies', {})['cookies']
+        except Exception:
+            cookies = self.driver.get_cookies()
+
+        # Swap the whole jar so threads never see it half filled
+        jar = RequestsCookieJar()
+        [jar.set(cookie['name'], cookie['value'], domain=cookie.get('domain', ''), path=cookie.get('path', '/'))
+         for cookie in cookies]
+        self.session.cookies = jar
 
-            if add_cookies:
-                [session.cookies.set(cookie['name'], cookie['value'])
-                 for cookie in self.driver.get_cookies()]
+    def get_html_by_requests(self, url: str, print_error: bool = True, add_cookies: bool = False, timeout: float = 15) -> Optional[str]:
+        try:
+            # Cookies are copied from the browser once, not on every request
+            if add_cookies and not self.session.cookies:
+                self.sync_session_cookies()
 
-            response = session.get(url)
+            response = self.session.get(url, timeout=timeout)
             if response.status_code == 200:
-                return BeautifulSoup(response.text, 'html.parser')
+                # Decoded here with the charset from the headers, lxml would guess latin-1 from bytes
+                return response.text
             elif print_error:
                 print('Request failed, status code: {}, url: {}'.format(
                     response.status_code, url))
-        except (ReadTimeout, ConnectTimeout, SSLError) as err:
+        except (ReadTimeout, ConnectTimeout, SSLError, RequestsConnectionError) as err:
             if print_error:
                 print('{}: url: "{}"'.format(err.__class__, url))
         except Exception:
@@ -124,6 +174,14 @@ class SeleniumWrap:
 
         return None
 
+    def get_page_by_requests(self, url: str, print_error: bool = True, add_cookies: bool = False, timeout: float = 15) -> Optional[BeautifulSoup]:
+        html = self.get_html_by_requests(
+            url, print_error=print_error, add_cookies=add_cookies, timeout=timeout)
+        if html is None:
+            return None
+
+        return BeautifulSoup(html, 'html.parser')
+
     def login_with_cookies(self, is_logged_in_selector: str, cookie_file: str, timeout: float = 5) -> bool:
 
         # Check if already logged in
@@ -1,9 +1,19 @@
+from dotenv import load_dotenv
+import os
+
 from modules.difox import Difox
 
+load_dotenv()
 
-difox = Difox('files', True)
 
-difox.scrape_product('https://www.difox.com/en/agfa-compact-cam-dc5200-schwarz-603962-en')
-difox.scrape_product('https://www.difox.com/en/amd-ryzen-5-5600g-3-9ghz-668474-en')
+# Guarded so the parse worker processes don't re-run it when importing __main__
+if __name__ == '__main__':
+    difox = Difox(os.getenv('difox_user'), os.getenv('difox_pass'), os.getenv('file_directory', 'files'),
+                  test_env=True, network_log=True)
+    difox.handle_login()
 
+    print(difox.scrape_product('https://www.difox.com/en/agfa-compact-cam-dc5200-schwarz-603962-en'))
+    print(difox.scrape_product('https://www.difox.com/en/amd-ryzen-5-5600g-3-9ghz-668474-en'))
 
+    print(difox.find_product_api('https://www.difox.com/en/agfa-compact-cam-dc5200-schwarz-603962-en'))
+    del difox